@@ -9,12 +9,18 @@ Created on Tue Sep 26 14:22:29 2023
 
 
 import os,sys
+from pathlib import Path
 import time
 import math
+import re
+import threading
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
 from datetime import timedelta
 import pickle
-import urllib.request
+import csv
+import requests
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
@@ -25,16 +31,22 @@ import discogs_client
 from pytube import YouTube 
 from fuzzywuzzy import fuzz
 
-import shutil
 import librosa
-import io
 import subprocess
-import soundfile as sf
-import librosa.display
 import keyfinder
 from pylatexenc.latexencode import unicode_to_latex
 
 import segno
+from PIL import Image
+
+
+
+# one keep-alive session for all cover downloads, shared by the fetch threads:
+httpSession = requests.Session()
+httpSession.headers.update({'User-Agent': 'DiscogsRecordLabeler/0.1'})
+
+# caps the youtube downloads running at once over all releases fetched in parallel:
+downloadSlots = threading.BoundedSemaphore(4)
 
 
 
@@ -51,14 +63,13 @@ what is to do?
 
 def main():
     
-    databaseDIR = os.path.dirname(os.path.abspath(sys.argv[0])) + '/' + 'DiscogsDatabase'
+    scriptDIR = Path(os.path.abspath(sys.argv[0])).parent
+    databaseDIR = scriptDIR / 'DiscogsDatabase'
     
 
     print("starting discogs script\n")
     # reading token from local file:
-    f = open(os.path.expanduser('~') + '/.config/discogs_token', "r")
-    discogs_token=f.read().strip()
-    f.close()
+    discogs_token = (Path.home() / '.config' / 'discogs_token').read_text().strip()
 
 
     # connectiong to discogs:
@@ -72,33 +83,49 @@ def main():
     
     
     """ MAIN loop thru discogs collection:"""
-    for i in range(len(collection)):
-    # for i in range(0,20):
-        print("processing id: " + str(collection[i].data['id']) + '  --  ' + collection[i].release.title)
-        # print(unicode_to_latex(collection[i].release.title))
-        timestampRecordAdded = convert_to_datetime(collection[i].data['date_added'])
-        
-        print("retrieving metadata from discogs")
-        crawlReleaseData(collection[i].release,timestampRecordAdded, databaseDIR)
-        
-        print("downloading videos from youtube:")
-        downloadYoutube(collection[i].release, databaseDIR)
-        
-        # print("analyze videos:")
-        analyzeDownloadedVideos(collection[i].release, databaseDIR)
+    # walk the paginated collection once instead of indexing into it:
+    collectionItems = list(collection)
+    # collectionItems = collectionItems[0:20]
+    
+    # discogs and youtube requests are network bound, so fetch several releases at once:
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        list(executor.map(fetchRelease, collectionItems, repeat(databaseDIR)))
+    
+    releases = [collectionItem.release for collectionItem in collectionItems]
+    
+    # print("analyze videos:")
+    # one process pool for all records, started after the download threads are gone:
+    analyzeDownloadedVideos(releases, databaseDIR)
+    
+    for release in releases:
         
         # print("create qr codes:")
-        createQRCode(collection[i].release, databaseDIR)
+        createQRCode(release, databaseDIR)
         
         # print("creating latex label file for record:")
-        createLatexLabelFile(collection[i].release, databaseDIR)
+        createLatexLabelFile(release, databaseDIR)
          
-    exportDIR = os.path.dirname(os.path.abspath(sys.argv[0])) + '/' + 'export'
+    exportDIR = scriptDIR / 'export'
     combineLatex(databaseDIR, exportDIR)
 
 
 
 
+def fetchRelease(collectionItem, databaseDIR):
+    release = collectionItem.release
+    print("processing id: " + str(collectionItem.data['id']) + '  --  ' + release.title)
+    # print(unicode_to_latex(release.title))
+    timestampRecordAdded = convert_to_datetime(collectionItem.data['date_added'])
+    
+    print("retrieving metadata from discogs")
+    metadata = crawlReleaseData(release,timestampRecordAdded, databaseDIR)
+    
+    print("downloading videos from youtube:")
+    downloadYoutube(release, metadata, databaseDIR)
+    return
+
+
+
 def convert_to_datetime(datetime_string):
     tz_offset = datetime.strptime(datetime_string[-5:], "%H:%M")
     return datetime.strptime(datetime_string[:-6], '%Y-%m-%dT%H:%M:%S') + timedelta(hours=tz_offset.hour)
@@ -106,13 +133,12 @@ def convert_to_datetime(datetime_string):
 
 def crawlReleaseData(collectionElement,timestampOfRecord, databaseDIR):
     
-    elementDirectory = databaseDIR + '/' + str(collectionElement.id)
+    elementDirectory = databaseDIR / str(collectionElement.id)
     
-    if not os.path.exists(elementDirectory):
-        os.makedirs(elementDirectory)
+    elementDirectory.mkdir(parents=True, exist_ok=True)
     
     # retrieve Metadata
-    if not os.path.isfile(elementDirectory + '/' + 'metadata' ):
+    if not (elementDirectory / 'metadata').is_file():
         metaData = {
             "title": collectionElement.title,
             "artist": [r.name for r in collectionElement.artists],
@@ -124,43 +150,52 @@ def crawlReleaseData(collectionElement,timestampOfRecord, databaseDIR):
             "timestamp": timestampOfRecord,
             "videos" : [video.url for video in collectionElement.videos]
             }
-        with open(elementDirectory + '/' + 'metadata', 'wb') as fp:
+        with open(elementDirectory / 'metadata', 'wb') as fp:
             pickle.dump(metaData, fp)
             # print('metadata saved successfully to file')
     else: #if metadata alread there, skip it!
-        pass
+        with open(elementDirectory / 'metadata', 'rb') as fp:
+            metaData = pickle.load(fp)
     
     # retrieve Tracklist 
-    if not os.path.isfile(elementDirectory + '/' + 'tracklist.csv' ):
+    if not (elementDirectory / 'tracklist.csv').is_file():
         # print("tracklist nicht vorhanden")
         # generate tracktable:
         tracklist = []
         for track in collectionElement.tracklist:
             tracklist.append([track.position, track.title, ','.join([r.name for r in track.artists]),track.duration])
-        #convert to pandas:
-        tracklist = np.array(tracklist)
-        tracklist = pd.DataFrame(tracklist, columns=['pos', 'title', 'artist', 'duration'])
-        # save to file (which was not existing:)
-        tracklist.to_csv(elementDirectory + '/' + 'tracklist.csv', index=False)
+        # save to file (which was not existing), four fixed columns need no DataFrame:
+        with open(elementDirectory / 'tracklist.csv', 'w', newline='') as fp:
+            writer = csv.writer(fp, lineterminator='\n')
+            writer.writerow(['pos', 'title', 'artist', 'duration'])
+            writer.writerows(tracklist)
     else:
         pass
     
     # retrieve Cover Image:
-    if not os.path.isfile(elementDirectory + '/' + 'cover.jpg' ):
+    if not (elementDirectory / 'cover.jpg').is_file():
         try:
             imageURL = collectionElement.images[0]['uri']
         except:
             imageURL = ''
         
         if imageURL != '':
+            # stream into a part file, a broken transfer must not leave a truncated cover.jpg behind:
+            partPath = elementDirectory / 'cover.jpg.part'
             try:
                 print("downloading Cover of " + str(collectionElement.id))
-                urllib.request.urlretrieve(imageURL, elementDirectory + '/' + 'cover.jpg')
+                with httpSession.get(imageURL, stream=True, timeout=15) as response:
+                    response.raise_for_status()
+                    with open(partPath, 'wb') as fp:
+                        for chunk in response.iter_content(65536):
+                            fp.write(chunk)
+                os.replace(partPath, elementDirectory / 'cover.jpg')
             except:
-                pass
+                print("cover download failed for " + str(collectionElement.id))
+                partPath.unlink(missing_ok=True)
         else:
             pass
-    return
+    return metaData
 
 
 
@@ -172,8 +207,9 @@ def video_info(yt):
 
 
 
-def retrieveYoutubeMetadata(videos):
+def retrieveYoutubeMetadata(videos, ytObjects):
     # request, process and return metadata of youtube videos
+    # the YouTube objects are kept in ytObjects (by url) so downloads can reuse them
     # if len(videos) > 0:
     videoTitles = []
     videoLengths = []
@@ -182,6 +218,7 @@ def retrieveYoutubeMetadata(videos):
         try:
             yt = YouTube(videoURI)
             ytData = video_info(yt)        
+            ytObjects[videoURI] = yt
             videoTitles.append(ytData[0])
             videoLengths.append(ytData[1])
             videoArtists.append(ytData[2])
@@ -200,10 +237,26 @@ def duplicates(arr):
 
 
 
+def downloadVideo(url, recordPath, filename, yt=None):
+    with downloadSlots:
+        try:
+            if yt is None:
+                yt = YouTube(url)
+            youtube = yt.streams.get_by_itag(140) # m4a stream
+            youtube.download(str(recordPath),filename=filename)
+        except:
+            print("download failed: " + url + " -> " + str(recordPath / filename))
+            pass
+    return
+
+
+
+
 def matchVideosWithTracklist(tracklist,metadata,databaseDIR):
-    videos = retrieveYoutubeMetadata(metadata["videos"])
+    ytObjects = {}
+    videos = retrieveYoutubeMetadata(metadata["videos"], ytObjects)
     tracklist.artist.fillna(' & '.join(metadata["artist"]), inplace=True)
-    recordPath = databaseDIR + '/' + str(metadata['id'])    
+    recordPath = databaseDIR / str(metadata['id'])
     
     for video in videos:
         if video[3] !=  "nan":
@@ -246,22 +299,29 @@ def matchVideosWithTracklist(tracklist,metadata,databaseDIR):
             # print(stringCompareResultsOfTrack)
             pass
 
-    # download videos:
+    # download videos (one directory scan instead of a stat per video):
+    with os.scandir(recordPath) as entries:
+        recordFiles = {entry.name for entry in entries if entry.is_file()}
+    downloadURLs = []
+    downloadFilenames = []
+    downloadYTs = []
     for video in videos:
         if video[4] != np.nan and video[4] != 'nan':
             filename = video[4]+'.m4a'
-            if not os.path.isfile(databaseDIR + '/'+ str(metadata['id']) + '/' + filename):
-                try:
-                    url = video[0]
-                    yt = YouTube(url)
-                    youtube = yt.streams.get_by_itag(140) # m4a stream
-                    youtube.download(recordPath + '/',filename=video[4] +'.m4a')
-                except:
-                    pass
+            # several videos can match the same track, only the first one is downloaded:
+            if filename not in recordFiles:
+                recordFiles.add(filename)
+                downloadURLs.append(video[0])
+                downloadFilenames.append(filename)
+                downloadYTs.append(ytObjects.get(video[0]))
             else:
                 pass
         else:
             pass
+    
+    # downloads are network bound and independent of each other, run a few at once (bounded by downloadSlots):
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        list(executor.map(downloadVideo, downloadURLs, repeat(recordPath), downloadFilenames, downloadYTs))
                 
     # adjust duration of track if not in tracklist and duration is available for youtube video
     if tracklist.duration.isna: #check if there is nan in the tracklist durations
@@ -272,7 +332,7 @@ def matchVideosWithTracklist(tracklist,metadata,databaseDIR):
                 pass
             else:
                 pass
-        tracklist.to_csv(recordPath + '/' + 'tracklist.csv', index=False) # save to tracklist file
+        tracklist.to_csv(recordPath / 'tracklist.csv', index=False) # save to tracklist file
     else:
         pass 
         
@@ -281,14 +341,12 @@ def matchVideosWithTracklist(tracklist,metadata,databaseDIR):
 
 
 
-def downloadYoutube(collectionElement, databaseDIR):
-    elementID = str(collectionElement.id)
-    if os.path.exists(databaseDIR + '/' + elementID):
-        tracklist = pd.read_csv(databaseDIR + '/' + elementID + '/' +  'tracklist.csv')
-        # Read dictionary pkl file
-        with open(databaseDIR + '/' + elementID + '/' + 'metadata', 'rb') as fp:
-            metadata = pickle.load(fp)
-            matchVideosWithTracklist(tracklist, metadata, databaseDIR)
+def downloadYoutube(collectionElement, metadata, databaseDIR):
+    recordPath = databaseDIR / str(collectionElement.id)
+    if recordPath.exists():
+        tracklist = pd.read_csv(recordPath / 'tracklist.csv')
+        # metadata is handed over from crawlReleaseData, no need to unpickle it again
+        matchVideosWithTracklist(tracklist, metadata, databaseDIR)
     else:
         pass
     return
@@ -296,21 +354,162 @@ def downloadYoutube(collectionElement, databaseDIR):
 
 
 
-def analyzeDownloadedVideos(collectionElement, databaseDIR):
-    
-    """read old analyzed.csv file:"""
+def probeDuration(filePath):
+    # ask ffprobe for the duration (in seconds) of the first audio stream:
+    ffprobe_command = ["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "csv=p=0", filePath]
+    # without ffprobe the estimate is 0 and readAudioFile simply grows its buffer:
     try:
-        analyzed = pd.read_csv(databaseDIR + '/' + str(collectionElement.id) + '/' + 'analyzed.csv')
-    except FileNotFoundError: 
-        analyzed = pd.DataFrame(columns=['pos', 'bpm', 'key'])
+        output = subprocess.run(ffprobe_command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout
+        return float(output.strip())
+    except (OSError, ValueError):
+        return 0.0
+
+
+
+def readAudioFile(filePath, sampleRate):
+    # decode to mono 16bit pcm and stream it straight into a preallocated buffer:
+    ffmpeg_command = ["ffmpeg", "-i", filePath,
+                    "-ac", "1", "-filter:a", "aresample="+str(sampleRate), "-map", "0:a", "-c:a", "pcm_s16le", "-f", "data", '-']
+    pcm = np.empty(int(math.ceil(probeDuration(filePath) * sampleRate)) + sampleRate, dtype=np.int16)
+    ffmpeg_pipe = subprocess.Popen(ffmpeg_command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, bufsize=1<<20)
+    
+    offset = 0 # in bytes
+    while True:
+        if offset == pcm.nbytes:
+            # duration from ffprobe was too short, grow buffer:
+            pcm = np.concatenate((pcm, np.empty(len(pcm) // 2 + sampleRate, dtype=np.int16)))
+        nread = ffmpeg_pipe.stdout.readinto(pcm.view(np.uint8)[offset:])
+        if not nread:
+            break
+        offset += nread
+    ffmpeg_pipe.stdout.close()
+    ffmpeg_pipe.wait()
     
-    """compare with FILES(!) and only analyze slots which have not yet been analyzed: """
+    return pcm[:offset // 2]
+
+
+
+def renderWaveform(pcm, filePath, width=2500, height=250):
+    # min/max of every pixel column, drawn black on white like the old gnuplot plot:
+    if len(pcm) == 0:
+        return
+    # always exactly width columns, short tracks repeat samples over neighbouring columns:
+    starts = np.linspace(0, len(pcm), width + 1)[:-1].astype(np.intp)
+    lo = np.minimum.reduceat(pcm, starts).astype(np.int32)
+    hi = np.maximum.reduceat(pcm, starts).astype(np.int32)
+    
+    # autoscale to the loudest sample and map amplitudes to pixel rows:
+    peak = max(np.abs(lo).max(), np.abs(hi).max(), 1)
+    scale = (height - 1) / (2.0 * peak)
+    top = np.floor((peak - hi) * scale)
+    bottom = np.ceil((peak - lo) * scale)
+    rows = np.arange(height)[:, None]
+    
+    image = np.full((height, width), 255, dtype=np.uint8)
+    image[(rows >= top) & (rows <= bottom)] = 0
+    Image.fromarray(image).save(filePath)
+    return
+
+
+
+def analyzeTrack(recordPath, file, title, sampleRate, waveformGen, keyAndBpmCHeck):
+    # runs in a worker process, returns [pos, bpm, key] or None
+    result = None
     
+    waveformPath = recordPath / (file[:-4] + "_waveform.png")
+    plotWaveform = waveformGen and not waveformPath.is_file()
     
-    recordPath = databaseDIR + '/' + str(collectionElement.id)
+    # decode only once, waveform and bpm analysis share the same samples:
+    if plotWaveform or keyAndBpmCHeck:
+        pcm = readAudioFile(recordPath / file, sampleRate)
+    else:
+        return result
+    
+    """ generate waveform: """
+    if plotWaveform: 
+        renderWaveform(pcm, waveformPath)
+    else:
+        pass
     
-    #get downloaded youtube videos on local disk:
-    files = [file for file in os.listdir(recordPath) if file.endswith(".m4a")]
+    if keyAndBpmCHeck:
+        # print("bpm check")
+        hop_length=512
+        # stay in float32, librosa keeps the dtype through the stft instead of promoting to float64:
+        y = pcm.astype(np.float32)
+        y *= np.float32(1.0 / 32768)
+        sr = sampleRate
+        # print("2")
+        onset_env = librosa.onset.onset_strength(y=y, sr=sampleRate, hop_length=hop_length)
+        # print("3")
+        # tempogram with the same 8s window tempo() would use, shared by both estimates below:
+        tg = librosa.feature.tempogram(onset_envelope=onset_env, sr=sr, hop_length=hop_length,
+                                       win_length=librosa.time_to_frames(8.0, sr=sr, hop_length=hop_length).item())
+                        
+        bpm = librosa.feature.tempo(tg=tg, sr=sr, hop_length=hop_length)[0]
+        print(bpm)
+        key = keyfinder.key(str(recordPath / file))
+        
+        result = [file[:-4], str(int(np.round(bpm))), key.camelot()]
+        
+
+        # Convert to scalar
+        tempo = bpm.item()
+        prior = scipy.stats.uniform(30, 300)
+        utempo = librosa.feature.tempo(tg=tg, sr=sr, hop_length=hop_length, prior=prior)
+        utempo = utempo.item()
+        # dtempo = librosa.feature.tempo(onset_envelope=onset_env, sr=sr,
+                       # aggregate=None)
+        # prior_lognorm = scipy.stats.lognorm(loc=np.log(120), scale=120, s=1)
+        # dtempo_lognorm = librosa.feature.tempo(onset_envelope=onset_env, sr=sr,
+                       # aggregate=None,
+                       # prior=prior_lognorm)
+        
+        # Compute 2-second windowed autocorrelation
+        hop_length = 512
+        ac = librosa.autocorrelate(onset_env, max_size=2 * sr // hop_length)
+        freqs = librosa.tempo_frequencies(len(ac), sr=sr,
+                                          hop_length=hop_length)
+        # Plot on a BPM axis.  We skip the first (0-lag) bin.
+        fig, ax = plt.subplots()
+        ax.semilogx(freqs[1:], librosa.util.normalize(ac)[1:],
+                     label='Onset autocorrelation', base=2)
+        ax.axvline(tempo, 0, 1, alpha=0.75, linestyle='--', color='r',
+                    label='Tempo (default prior): {:.2f} BPM'.format(tempo))
+        ax.axvline(utempo, 0, 1, alpha=0.75, linestyle=':', color='g',
+                    label='Tempo (uniform prior): {:.2f} BPM'.format(utempo))
+        ax.set(xlabel='Tempo (BPM)', title='Static tempo estimation: '+ title + ' - ' + file[:-4])
+        ax.grid(True)
+        ax.legend()
+        # plt.show()
+        fig.savefig(recordPath / ('static_tempo_est_' + file[:-4] + '.pdf'), bbox_inches='tight')
+        plt.close(fig)
+        del ac, utempo, prior, tempo, bpm, key, tg, onset_env, y, sr, fig, ax
+        
+        # fig, ax = plt.subplots()
+        # tg = librosa.feature.tempogram(onset_envelope=onset_env, sr=sr,
+        #                                hop_length=hop_length)
+        # librosa.display.specshow(tg, x_axis='time', y_axis='tempo', cmap='magma', ax=ax)
+        # ax.plot(librosa.times_like(dtempo), dtempo,
+        #          color='c', linewidth=1.5, label='Tempo estimate (default prior)')
+        # ax.plot(librosa.times_like(dtempo_lognorm), dtempo_lognorm,
+        #          color='c', linewidth=1.5, linestyle='--',
+        #          label='Tempo estimate (lognorm prior)')
+        # ax.set(title='Dynamic tempo estimation')
+        # ax.legend()
+        # plt.show()
+        # plt.close()
+        
+    return result
+
+
+
+def naturalSortKey(position):
+    # vinyl positions like A2 / A10 / B1: compare the numbers as numbers, not as text
+    return [int(part) if part.isdigit() else part.lower() for part in re.split(r'(\d+)', str(position))]
+
+
+
+def analyzeDownloadedVideos(releases, databaseDIR):
     
     # options:
     waveformGen= False
@@ -318,128 +517,82 @@ def analyzeDownloadedVideos(collectionElement, databaseDIR):
     sampleRate = 44100
     # sampleRate = 22050
     
-    results = []
-    
-    for file in files:
-        if file.endswith(".m4a") and file[:-4] not in analyzed.pos.unique():
-            # set ffmpeg command:
-            ffmpeg_command = ["ffmpeg", "-i", recordPath + '/' + file,
-                            "-ac", "1", "-filter:a", "aresample="+str(sampleRate), "-map", "0:a", "-c:a", "pcm_s16le", "-f", "data", '-']
-            # run ffmpeg command pipe:
-            ffmpeg_pipe = subprocess.Popen(ffmpeg_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)            
-            """ generate waveform: """
-            if waveformGen: 
-                if not os.path.isfile(recordPath +'/'+ file[:-4]+ "_waveform.png"):
-                    #define gnuplot command:
-                    gnuplot_command = ['gnuplot', '-persist', '-c', 'waveform.gnuplot', "set terminal png size 5000,500;\n", "set output 'blabla.png';\n;"]
-                    #start gnuplot as subprocess:
-                    plot = subprocess.Popen(gnuplot_command, stdin=ffmpeg_pipe.stdout, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                    #send gnuplot command and end process:
-                    plot.communicate("set terminal png size 5000,500;\n set output 'blabla.png';\n;") # inhalt funktioniert nicht, aber ist wichtig um die plots richtig zu erstellen
-                    del plot
-                    #move waveform file to record folder and rename it:
-                    if os.path.isfile("waveform.png"):
-                        shutil.move("waveform.png", recordPath +'/'+ file[:-4]+ "_waveform.png")
-                    else:
-                        pass
-                    
-                    plot.kill()
-                    
+    tasks = [] # (recordPath, file, title) of every track still to analyze, over all records
+    records = {} # recordPath -> [old analyzed rows, new rows]
+    
+    for collectionElement in releases:
+        recordPath = databaseDIR / str(collectionElement.id)
+        
+        """read old analyzed.csv file:"""
+        try:
+            analyzed = pd.read_csv(recordPath / 'analyzed.csv')
+            analyzedFileExists = True
+        except FileNotFoundError: 
+            analyzed = pd.DataFrame(columns=['pos', 'bpm', 'key'])
+            analyzedFileExists = False
+        
+        """compare with FILES(!) and only analyze slots which have not yet been analyzed: """
+        
+        
+        # with waveform and bpm/key analysis switched off there is nothing to compute for any track:
+        if waveformGen or keyAndBpmCHeck:
+            #get downloaded youtube videos on local disk:
+            with os.scandir(recordPath) as entries:
+                files = [entry.name for entry in entries if entry.name.endswith(".m4a") and entry.is_file()]
+            analyzedPositions = set(analyzed.pos)
+            files = [file for file in files if file[:-4] not in analyzedPositions]
+        else:
+            files = []
+        
+        # everything already analyzed, no need to rewrite the csv:
+        if not files and analyzedFileExists:
+            continue
+        
+        records[recordPath] = [analyzed.values.tolist(), []]
+        for file in files:
+            tasks.append((recordPath, file, collectionElement.title))
+    
+    # every track is independent (decode, waveform, bpm, key), so one pool serves all records:
+    if tasks:
+        with ProcessPoolExecutor(max_workers=min(os.cpu_count() or 1, len(tasks))) as executor:
+            futures = [(recordPath, file, executor.submit(analyzeTrack, recordPath, file, title,
+                                                          sampleRate, waveformGen, keyAndBpmCHeck))
+                       for recordPath, file, title in tasks]
+            for recordPath, file, future in futures:
+                # a broken track only loses its own result, not those of the whole batch:
+                try:
+                    result = future.result()
+                except Exception:
+                    print("analysis failed: " + str(recordPath / file))
+                    result = None
+                if result is not None:
+                    records[recordPath][1].append(result)
                 else:
                     pass
-            else:
-                pass
-            
-            if keyAndBpmCHeck:
-                # print("bpm check")
-                hop_length=512
-                y, sr = sf.read(io.BytesIO(ffmpeg_pipe.stdout.read()), format='RAW', samplerate=sampleRate, channels=1, subtype="PCM_16", endian='LITTLE')
-                # print("2")
-                onset_env = librosa.onset.onset_strength(y=y, sr=sampleRate, hop_length=hop_length)
-                # print("3")
-                                
-                bpm = librosa.feature.tempo(onset_envelope=onset_env, sr=sr)[0]
-                print(bpm)
-                key = keyfinder.key(recordPath + '/' + file)
-                
-                results.append([file[:-4], str(int(np.round(bpm))), key.camelot()])
-                
-
-                # Convert to scalar
-                tempo = bpm.item()
-                prior = scipy.stats.uniform(30, 300)
-                utempo = librosa.feature.tempo(onset_envelope=onset_env, sr=sr, prior=prior)
-                utempo = utempo.item()
-                # dtempo = librosa.feature.tempo(onset_envelope=onset_env, sr=sr,
-                               # aggregate=None)
-                # prior_lognorm = scipy.stats.lognorm(loc=np.log(120), scale=120, s=1)
-                # dtempo_lognorm = librosa.feature.tempo(onset_envelope=onset_env, sr=sr,
-                               # aggregate=None,
-                               # prior=prior_lognorm)
-                
-                # Compute 2-second windowed autocorrelation
-                hop_length = 512
-                ac = librosa.autocorrelate(onset_env, max_size=2 * sr // hop_length)
-                freqs = librosa.tempo_frequencies(len(ac), sr=sr,
-                                                  hop_length=hop_length)
-                # Plot on a BPM axis.  We skip the first (0-lag) bin.
-                fig, ax = plt.subplots()
-                ax.semilogx(freqs[1:], librosa.util.normalize(ac)[1:],
-                             label='Onset autocorrelation', base=2)
-                ax.axvline(tempo, 0, 1, alpha=0.75, linestyle='--', color='r',
-                            label='Tempo (default prior): {:.2f} BPM'.format(tempo))
-                ax.axvline(utempo, 0, 1, alpha=0.75, linestyle=':', color='g',
-                            label='Tempo (uniform prior): {:.2f} BPM'.format(utempo))
-                ax.set(xlabel='Tempo (BPM)', title='Static tempo estimation: '+ collectionElement.title + ' - ' + file[:-4])
-                ax.grid(True)
-                ax.legend()
-                # plt.show()
-                plt.savefig(recordPath + '/' + 'static_tempo_est_' + file[:-4] + '.pdf', bbox_inches='tight')
-                # plt.show()
-                plt.close()
-                del ac, utempo, prior, tempo, bpm, key, onset_env, y, sr, ffmpeg_pipe
-                
-                # fig, ax = plt.subplots()
-                # tg = librosa.feature.tempogram(onset_envelope=onset_env, sr=sr,
-                #                                hop_length=hop_length)
-                # librosa.display.specshow(tg, x_axis='time', y_axis='tempo', cmap='magma', ax=ax)
-                # ax.plot(librosa.times_like(dtempo), dtempo,
-                #          color='c', linewidth=1.5, label='Tempo estimate (default prior)')
-                # ax.plot(librosa.times_like(dtempo_lognorm), dtempo_lognorm,
-                #          color='c', linewidth=1.5, linestyle='--',
-                #          label='Tempo estimate (lognorm prior)')
-                # ax.set(title='Dynamic tempo estimation')
-                # ax.legend()
-                # plt.show()
-                # plt.close()
-                
-            if 'ffmpeg_pipe' in locals():
-                ffmpeg_pipe.kill()
-            else:
-                pass
-        else:
-            # print("already analyzed")
-            pass
-                
-    results = pd.DataFrame(results, columns = ['pos', 'bpm', 'key']) 
-    results = results.sort_values('pos')
-    results = pd.concat([analyzed, results], ignore_index=True)
-    results.to_csv(recordPath + '/' + 'analyzed.csv', index=False)
+    
+    for recordPath, (oldRows, results) in records.items():
+        # old rows first, then the new ones sorted by position, built into a single frame:
+        results.sort(key=lambda row: naturalSortKey(row[0]))
+        results = pd.DataFrame(oldRows + results, columns = ['pos', 'bpm', 'key'])
+        results.to_csv(recordPath / 'analyzed.csv', index=False)
     
     return
 
 
 
 def createQRCode(collectionElement, databaseDIR):
-    if os.path.isfile(databaseDIR + '/' + str(collectionElement.id) + '/' + "cover.jpg"):
+    recordPath = databaseDIR / str(collectionElement.id)
+    coverPath = recordPath / 'cover.jpg'
+    qrcodePath = recordPath / 'qrcode.png'
+    if coverPath.is_file():
         # print("cover existiert")
-        if not os.path.isfile(databaseDIR + '/' + str(collectionElement.id) + '/' + 'qrcode.png'):
+        if not qrcodePath.is_file():
             #create qr code:
             slts_qrcode = segno.make_qr('discogs.com/release/' + str(collectionElement.id), error='l')
             #save qr code with cover in background:
             slts_qrcode.to_artistic(
-                background=databaseDIR + '/' + str(collectionElement.id) + '/' + 'cover.jpg',
-                target=databaseDIR + '/' + str(collectionElement.id) + '/' + 'qrcode.png',
+                background=str(coverPath),
+                target=str(qrcodePath),
                 scale=10
             )
         else:
@@ -451,35 +604,17 @@ def createQRCode(collectionElement, databaseDIR):
 
 
 
-def inplace_change(filename, old_string, new_string):
-    # Safely read the input filename using 'with'
-    with open(filename) as f:
-        s = f.read()
-        if old_string not in s:
-            print('"{old_string}" not found in {filename}.'.format(**locals()))
-            return
-        
-        # Safely write the changed content, if found in the file
-    with open(filename, 'w') as f:
-        print('Changing "{old_string}" to "{new_string}" in {filename}'.format(**locals()))
-        s = s.replace(old_string, new_string)
-        f.write(s)
-    return
-
-
-
-
 def createLatexLabelFile(collectionElement, databaseDIR):
-    recordPath = databaseDIR + '/' + str(collectionElement.id)
-    if os.path.isfile(recordPath + '/' + 'label.tex'):
+    recordPath = databaseDIR / str(collectionElement.id)
+    if (recordPath / 'label.tex').is_file():
         # print("label wird erstellt")
         #read metadata:
-        with open((recordPath + '/' + 'metadata'), 'rb') as fp:
+        with open(recordPath / 'metadata', 'rb') as fp:
             metadata = pickle.load(fp)
         # read tracklist:
-        tracklist = pd.read_csv(recordPath + '/' + 'tracklist.csv' )
+        tracklist = pd.read_csv(recordPath / 'tracklist.csv')
         # read analyze results:
-        analyzedData = pd.read_csv(recordPath + '/' + 'analyzed.csv' )
+        analyzedData = pd.read_csv(recordPath / 'analyzed.csv')
         #merge data:
         trackDF = tracklist.merge(analyzedData, how='left')
         
@@ -489,10 +624,12 @@ def createLatexLabelFile(collectionElement, databaseDIR):
         
         """ add waveform: """
         trackDF["waveform"] = np.nan
+        with os.scandir(recordPath) as entries:
+            recordFiles = {entry.name for entry in entries if entry.is_file()}
         for ind in trackDF.index:
-            if os.path.isfile(recordPath + '/' + trackDF.pos[ind]+ '.m4a'):
-                filepath = recordPath + '/' + trackDF.pos[ind]+ '_waveform.png'
-                trackDF.at[ind, 'waveform'] = '\\includegraphics[width=2cm]{' + filepath + '}'
+            if trackDF.pos[ind] + '.m4a' in recordFiles:
+                filepath = recordPath / (trackDF.pos[ind] + '_waveform.png')
+                trackDF.at[ind, 'waveform'] = '\\includegraphics[width=2cm]{' + str(filepath) + '}'
             else:
                 pass
             
@@ -519,25 +656,23 @@ def createLatexLabelFile(collectionElement, databaseDIR):
         """ extract year: """
         year = metadata["timestamp"].strftime("%Y")
         
-        with open(recordPath + '/' + 'label.tex', 'w') as f:
-            f.write(#\
-                "\
+        # tabularx instead of tabular, so the table fits into the label width:
+        latex = latex.replace("\\begin{tabular}", "\\begin{tabularx}{8.5cm}").replace("\\end{tabular}", "\\end{tabularx}")
+        
+        # assemble the whole label in memory and write it with a single call:
+        label = "\
                     \\begin{fitbox}{8cm}{4.5cm} \n \
                     \\textbf{" + unicode_to_latex(', '.join(metadata["artist"])) + "} \\newline \n \
                         " + unicode_to_latex(metadata["title"]) + "\n \
                     \\vfill \n \
                     % \\begin{minipage}{8cm} \n \
-                    \\scriptsize \n ")
-            for line in latex:
-                f.write(line)
-            f.write(" \
+                    \\scriptsize \n " + latex + " \
                     %\\end{minipage} \n \
                 \\vfill \n \
                 \\raggedright \\tinyb{ " + unicode_to_latex(', '.join(metadata["label"])) + ', ' + year + ', releaseID: ' + str(metadata["id"]) +"}\n \
-                \\end{fitbox}")
-                
-        inplace_change(recordPath + '/' + 'label.tex', "\\begin{tabular}", "\\begin{tabularx}{8.5cm}")
-        inplace_change(recordPath + '/' + 'label.tex', "\\end{tabular}", "\\end{tabularx}")
+                \\end{fitbox}"
+        with open(recordPath / 'label.tex', 'w') as f:
+            f.write(label)
                     
     else:
         print("label schon vorhanden")
@@ -549,13 +684,14 @@ def createLatexLabelFile(collectionElement, databaseDIR):
     
     
 def combineLatex(databaseDIR, exportDIR):
-    records = next(os.walk(databaseDIR))[1]
+    with os.scandir(databaseDIR) as entries:
+        records = [entry.name for entry in entries if entry.is_dir()]
     stickersToPrint = len(records)
     stickersToPrint = 15
     pagesToPrint = math.ceil(stickersToPrint / 10)
-    script_directory = os.path.dirname(os.path.abspath(sys.argv[0]))
-    with open(exportDIR + '/' + 'output.tex', 'w') as f:
-        latexTemplate = open(script_directory + '/' + 'functions' + '/' +'latexTemplate.tex', 'r')
+    script_directory = Path(os.path.abspath(sys.argv[0])).parent
+    with open(exportDIR / 'output.tex', 'w') as f:
+        latexTemplate = open(script_directory / 'functions' / 'latexTemplate.tex', 'r')
         for line in latexTemplate:
             f.write(line)
         latexTemplate.close()